@@ -0,0 +1,229 @@
+"""
+批量渲染命令行工具（不依赖AstrBot）
+
+把目录或通配符匹配到的图片按指定模式批量生成梗图，多进程并行，结果直接写入输出目录。
+已存在的结果会跳过，中断后重新运行同一条命令即可继续。
+
+用法：
+    python batch_render.py 输入目录或通配符 [...] -o 输出目录 [-m add|add1|add2] [-j 进程数]
+
+示例：
+    python batch_render.py ./photos -o ./out -m add1 --engine cv2
+    python batch_render.py "./event/**/*.jpg" -o ./out -m add2 -j 8
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif'}
+
+# 工作进程内的渲染器（每个进程加载一次）
+_renderer = None
+
+# 结果文件权限（按umask计算，与普通open创建的文件一致）
+_file_mode = 0o644
+
+
+def _init_worker(renderer_kwargs: dict, inner_threads: int, verbose: bool):
+    """工作进程初始化：设置内部线程数，加载模板/模型"""
+    global _renderer, _file_mode
+    from renderer import MemeRenderer
+    from thread_budget import ThreadBudget, apply_thread_budget
+
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING, format='%(processName)s %(message)s')
+    # 已经按进程并行，每个进程只分到 CPU数/进程数 个内部线程，避免互相抢占CPU
+    apply_thread_budget(ThreadBudget('throughput', 1, inner_threads))
+    _renderer = MemeRenderer(Path(__file__).parent, **renderer_kwargs)
+    # umask只能通过设置来读取，工作进程是单线程的，读取后立即恢复
+    umask = os.umask(0)
+    os.umask(umask)
+    _file_mode = 0o666 & ~umask
+
+
+def _render_file(mode: str, input_path: str, output_path: str):
+    """
+    在工作进程中渲染单个文件，先写临时文件再原子替换，中断时不会留下不完整的结果
+    返回 (输入大小, 输出大小)
+    """
+    with open(input_path, 'rb') as f:
+        image_data = f.read()
+    result = _renderer.render(mode, image_data)
+
+    output_dir, output_name = os.path.split(output_path)
+    os.makedirs(output_dir, exist_ok=True)
+    # 每个任务使用唯一的临时文件名，并发任务之间不会互相覆盖
+    fd, temp_path = tempfile.mkstemp(prefix=output_name + '.', suffix='.part', dir=output_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(result)
+        # mkstemp创建的文件权限是0600，改为按umask的普通权限，便于其他用户/Web服务读取
+        os.chmod(temp_path, _file_mode)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return len(image_data), len(result)
+
+
+def collect_inputs(patterns: list, exclude_dir: Path = None) -> list:
+    """
+    展开目录（递归）和通配符，返回去重排序后的图片路径
+    exclude_dir 下的文件（输出目录位于输入目录内时的已生成结果）不作为输入
+    """
+    files = set()
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            candidates = path.rglob('*')
+        elif glob.has_magic(pattern):
+            candidates = map(Path, glob.glob(pattern, recursive=True))
+        else:
+            candidates = [path]
+        files.update(p.resolve() for p in candidates if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+    if exclude_dir is not None:
+        files = {p for p in files if not p.is_relative_to(exclude_dir)}
+    return sorted(files)
+
+
+def plan_outputs(inputs: list, output_dir: Path) -> list:
+    """
+    输出路径保留相对于所有输入公共目录的子目录结构，在原文件名后追加.png（a.jpg → a.jpg.png）
+    保留原扩展名，同目录下的 a.jpg 和 a.png 不会写到同一个结果文件
+    """
+    if not inputs:
+        return []
+    root = Path(os.path.commonpath([str(p.parent) for p in inputs]))
+    return [output_dir / p.relative_to(root).with_name(p.name + '.png') for p in inputs]
+
+
+def find_output_collisions(inputs: list, outputs: list) -> list:
+    """
+    返回会写到同一个结果文件的输入组（按不区分大小写比较，兼容Windows/macOS文件系统）
+    """
+    groups = {}
+    for input_path, output_path in zip(inputs, outputs):
+        groups.setdefault(str(output_path).casefold(), []).append(input_path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def main():
+    from thread_budget import available_cpus
+
+    cpu_count = available_cpus()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='图片目录、文件或通配符（支持 **）')
+    parser.add_argument('-o', '--output', required=True, help='输出目录')
+    parser.add_argument('-m', '--mode', default='add', choices=('add', 'add1', 'add2'), help='渲染模式，对应 /add /add1 /add2')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count, help='并行进程数')
+    parser.add_argument('--max-inflight', type=int, default=0, help='同时提交的最大任务数（限制内存），默认为进程数的2倍')
+    parser.add_argument('--force', action='store_true', help='重新生成已存在的结果')
+    parser.add_argument('--engine', default='pillow', choices=('pillow', 'cv2'), help='/add、/add1 的合成引擎')
+    parser.add_argument('--face-detector', default='dnn', choices=('dnn', 'dlib'), help='/add2 的人脸检测后端')
+    parser.add_argument('--dlib-upsample', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出渲染日志')
+    args = parser.parse_args()
+
+    output_dir = Path(args.output).resolve()
+    inputs = collect_inputs(args.inputs, exclude_dir=output_dir)
+    if not inputs:
+        sys.exit("没有找到图片")
+    outputs = plan_outputs(inputs, output_dir)
+    collisions = find_output_collisions(inputs, outputs)
+    if collisions:
+        for group in collisions:
+            print(f"  ❌ 输出文件名冲突: {', '.join(map(str, group))}")
+        sys.exit("存在输出文件名冲突的输入图片，请重命名后再运行")
+
+    jobs = [(i, o) for i, o in zip(inputs, outputs) if args.force or not o.exists()]
+    skipped = len(inputs) - len(jobs)
+    print(f"共 {len(inputs)} 张图片，跳过已完成 {skipped} 张，待处理 {len(jobs)} 张（模式 {args.mode}，{args.jobs} 个进程）")
+
+    renderer_kwargs = {
+        'mode1_engine': args.engine,
+        'mode2_engine': args.engine,
+        'face_detector': args.face_detector,
+        'dlib_upsample': args.dlib_upsample,
+        # 每张图片只渲染一次，输入缓存不会命中，关闭以免每个进程白占内存
+        'input_cache_mb': 0,
+    }
+    max_inflight = args.max_inflight or args.jobs * 2
+    failures = []
+    done = 0
+    bytes_in = bytes_out = 0
+    start = time.perf_counter()
+
+    def new_pool():
+        return ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                                   initargs=(renderer_kwargs, max(1, cpu_count // args.jobs), args.verbose))
+
+    def collect(future, input_path) -> bool:
+        """记录一个已完成任务的结果，返回进程池是否已损坏"""
+        nonlocal done, bytes_in, bytes_out
+        broken = False
+        try:
+            size_in, size_out = future.result()
+            bytes_in += size_in
+            bytes_out += size_out
+            done += 1
+        except BrokenProcessPool:
+            # 无法确定是哪张图片导致进程退出，同一批在途任务都记为失败，重新运行时会重试
+            failures.append((input_path, "工作进程异常退出（可能被OOM终止或崩溃）"))
+            broken = True
+        except Exception as e:
+            failures.append((input_path, e))
+        print(f"\r[{done + len(failures)}/{len(jobs)}] 失败 {len(failures)}", end='', flush=True)
+        return broken
+
+    pending = {}
+    queue = deque(jobs)
+    pool = new_pool()
+    try:
+        while True:
+            broken = False
+            try:
+                # 只保持有限个任务在途，避免一次性提交全部任务占用内存
+                while queue and len(pending) < max_inflight:
+                    input_path, output_path = queue[0]
+                    future = pool.submit(_render_file, args.mode, str(input_path), str(output_path))
+                    queue.popleft()
+                    pending[future] = input_path
+            except BrokenProcessPool:
+                broken = True
+            if not pending and not broken:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                broken = collect(future, pending.pop(future)) or broken
+            if broken:
+                # 某个工作进程被杀死（OOM、cv2段错误等）后整个进程池不可用：
+                # 收集剩余在途任务（会立即以BrokenProcessPool结束），换一个新进程池继续处理队列
+                for future in wait(pending)[0]:
+                    collect(future, pending.pop(future))
+                pool.shutdown(wait=True, cancel_futures=True)
+                print("\n⚠️ 工作进程异常退出，重新创建进程池继续处理")
+                pool = new_pool()
+    except KeyboardInterrupt:
+        print("\n已中断，重新运行同一条命令可从中断处继续")
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    print()
+    print(f"完成 {done} 张，失败 {len(failures)} 张，跳过 {skipped} 张，耗时 {elapsed:.1f}s")
+    if done and elapsed > 0:
+        print(f"吞吐: {done / elapsed:.2f} 张/s，输入 {bytes_in / 1024 / 1024 / elapsed:.1f}MB/s，输出 {bytes_out / 1024 / 1024:.1f}MB")
+    for input_path, error in failures:
+        print(f"  ❌ {input_path}: {error}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+人脸检测后端基准测试：比较 /add2 的 dnn 与 dlib 检测后端
+
+用法：
+    python benchmarks/bench_face_detectors.py 图片或目录 [...] [--repeat 10] [--upsample 0]
+
+对每张图片输出两种后端的人脸定位中位耗时、检测到的头部数量，以及dlib相对dnn的耗时比例
+（dnn 后端在SSD未检出时还会依次运行Anime/Haar级联，与线上行为一致）
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PLUGIN_DIR))
+
+from renderer import MemeRenderer, MAX_DIMENSION, dlib  # noqa: E402
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
+
+
+def collect_images(paths: list) -> list:
+    images = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            images.extend(sorted(p for p in path.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES))
+        else:
+            images.append(path)
+    return images
+
+
+def load(path: Path):
+    """按 render_mode3 的方式解码并缩小到最大边长，返回 (img, gray)"""
+    img = cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    if max(w, h) > MAX_DIMENSION:
+        scale = MAX_DIMENSION / max(w, h)
+        img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_LINEAR)
+    return img, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def bench(renderer: MemeRenderer, img, gray, repeat: int):
+    """返回 (中位数ms, 头部数量)"""
+    h, w = gray.shape[:2]
+    heads = renderer._locate_heads(img, gray, h, w)  # 预热（dlib按线程加载模型）
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        renderer._locate_heads(img, gray, h, w)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), len(heads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='图片文件或目录')
+    parser.add_argument('--repeat', type=int, default=10, help='每张图片的重复次数')
+    parser.add_argument('--upsample', type=int, default=0, help='dlib 上采样次数')
+    parser.add_argument('--max-side', type=int, default=800, help='dlib 检测图最大边长')
+    args = parser.parse_args()
+
+    if dlib is None:
+        sys.exit("dlib 未安装：pip install dlib")
+
+    backends = {
+        'dnn': MemeRenderer(PLUGIN_DIR, face_detector='dnn'),
+        'dlib': MemeRenderer(PLUGIN_DIR, face_detector='dlib', dlib_upsample=args.upsample, dlib_max_side=args.max_side),
+    }
+
+    print(f"{'图片':<32}{'dnn ms':>10}{'头部':>6}{'dlib ms':>10}{'头部':>6}{'dlib/dnn':>10}")
+    ratios = []
+    for path in collect_images(args.paths):
+        loaded = load(path)
+        if loaded is None:
+            print(f"{path.name:<32}  无法解码，跳过")
+            continue
+        dnn_ms, dnn_heads = bench(backends['dnn'], *loaded, args.repeat)
+        dlib_ms, dlib_heads = bench(backends['dlib'], *loaded, args.repeat)
+        ratios.append(dlib_ms / dnn_ms)
+        print(f"{path.name[:31]:<32}{dnn_ms:>10.1f}{dnn_heads:>6}{dlib_ms:>10.1f}{dlib_heads:>6}{ratios[-1]:>10.2f}")
+
+    if ratios:
+        print(f"\ndlib/dnn 耗时比例中位数: {statistics.median(ratios):.2f}（{len(ratios)} 张图片）")
+
+
+if __name__ == '__main__':
+    main()
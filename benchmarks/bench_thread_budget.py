@@ -0,0 +1,98 @@
+"""
+线程预算基准测试：寻找本机最佳的 渲染线程数 x OpenCV内部线程数 组合
+
+用法：
+    python benchmarks/bench_thread_budget.py [--jobs 48] [--engine cv2]
+
+对每种组合一次性提交一批混合任务（/add、/add1、/add2，不同尺寸），输出：
+- 吞吐（张/s）
+- 单个任务从提交到完成的 p50/p95 延迟（包含排队）
+并标出 thread_budget 中 throughput / latency / legacy 三种配置对应的组合和推荐值
+"""
+import argparse
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PLUGIN_DIR))
+
+from bench_compositing import make_samples  # noqa: E402
+from renderer import MemeRenderer  # noqa: E402
+from thread_budget import PROFILES, ThreadBudget, apply_thread_budget, available_cpus, plan_thread_budget  # noqa: E402
+
+
+def powers_of_two(limit: int) -> list:
+    values, n = [], 1
+    while n <= limit:
+        values.append(n)
+        n *= 2
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+
+def run_batch(renderer: MemeRenderer, workload: list, workers: int) -> tuple:
+    """返回 (吞吐 张/s, p50 ms, p95 ms)，任何任务失败都直接抛出，避免失败任务拉高吞吐、拉低延迟"""
+
+    def timed(mode, data, submitted):
+        renderer.render(mode, data)
+        return (time.perf_counter() - submitted) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(timed, mode, data, time.perf_counter()) for mode, data in workload]
+        latencies = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return len(workload) / elapsed, statistics.median(latencies), p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=48, help='每种组合提交的任务数')
+    parser.add_argument('--engine', default='cv2', choices=('pillow', 'cv2'), help='/add、/add1 的合成引擎')
+    args = parser.parse_args()
+
+    cpus = available_cpus()
+    # 关闭输入缓存：否则预热后全部命中缓存，测不到对线程数最敏感的解码和缩小
+    renderer = MemeRenderer(PLUGIN_DIR, mode1_engine=args.engine, mode2_engine=args.engine, input_cache_mb=0)
+    samples = list(make_samples().values())
+    modes = ('add', 'add1', 'add2')
+    workload = [(modes[i % len(modes)], samples[i % len(samples)]) for i in range(args.jobs)]
+
+    # 预热：加载模板缓存
+    for mode in modes:
+        renderer.render(mode, samples[0])
+
+    planned = {}
+    for profile in PROFILES:
+        budget = plan_thread_budget(profile, cpus)
+        planned.setdefault((budget.workers, budget.inner_threads or cpus), []).append(profile)
+
+    combos = [(w, i) for w in powers_of_two(max(cpus, 8)) for i in powers_of_two(cpus) if w * i <= cpus * 2 or (w, i) in planned]
+    combos = sorted(set(combos) | set(planned))
+
+    print(f"可用CPU数: {cpus}，每组 {args.jobs} 个任务，引擎: {args.engine}")
+    print(f"{'渲染线程':>8}{'内部线程':>8}{'吞吐 张/s':>12}{'p50 ms':>10}{'p95 ms':>10}  配置")
+    results = []
+    for workers, inner in combos:
+        apply_thread_budget(ThreadBudget('bench', workers, inner))
+        throughput, p50, p95 = run_batch(renderer, workload, workers)
+        results.append((workers, inner, throughput, p50, p95))
+        label = ', '.join(planned.get((workers, inner), []))
+        print(f"{workers:>8}{inner:>8}{throughput:>12.2f}{p50:>10.0f}{p95:>10.0f}  {label}")
+
+    best_throughput = max(results, key=lambda r: r[2])
+    best_latency = min(results, key=lambda r: r[4])
+    print(f"\n吞吐最高: 渲染线程 {best_throughput[0]} x 内部线程 {best_throughput[1]}（{best_throughput[2]:.2f} 张/s）")
+    print(f"p95最低:  渲染线程 {best_latency[0]} x 内部线程 {best_latency[1]}（{best_latency[4]:.0f}ms）")
+    print("可在插件配置中设置 thread_profile，或用 max_workers 指定渲染线程数")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+端到端压测：用伪造的消息事件驱动插件的 /add、/add1、/add2 完整流程
+
+需要在装有AstrBot的环境中运行（插件通过包导入，插件目录名需是合法的Python包名）：
+    python benchmarks/load_generator.py [--concurrency 16] [--requests 200] [--modes add,add1,add2]
+        [--config mode1_engine=cv2 --config debug_watchdog=true] [--coalesce]
+
+- 本地启动aiohttp服务器提供测试图片，插件走真实的URL下载流程
+- 默认每个流程使用不同的URL（插件按URL合并下载），并在图片末尾追加随机字节（解码结果不变、内容哈希不同，
+  插件按内容哈希合并渲染），避免被请求合并掩盖真实负载；--coalesce 关闭这两项，用于测试相同图片的合并效果
+- 输出各模式端到端延迟、事件循环延迟、吞吐，以及按时间采样的RSS
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from aiohttp import web
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PLUGIN_DIR.parent))
+sys.path.insert(0, str(PLUGIN_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from astrbot.api.message_components import Image  # noqa: E402
+
+from bench_compositing import make_samples  # noqa: E402
+from loop_watchdog import LoopWatchdog  # noqa: E402
+
+
+class FakeEvent:
+    """只实现插件用到的 AstrMessageEvent 属性和方法"""
+
+    def __init__(self, user_id: str, session: str, message: list):
+        self.message_obj = SimpleNamespace(
+            sender=SimpleNamespace(user_id=user_id),
+            timestamp=int(time.time()),
+            message=message,
+        )
+        self.unified_msg_origin = session
+
+    def plain_result(self, text: str):
+        return ('plain', text)
+
+    def chain_result(self, chain: list):
+        return ('chain', chain)
+
+
+def read_rss_mb() -> float:
+    """当前进程常驻内存（MB），没有 /proc 时退回到峰值RSS"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def start_fixture_server(fixtures: dict, coalesce: bool):
+    """返回 (runner, 基础URL)"""
+    async def serve(request: web.Request):
+        data = fixtures.get(request.match_info['name'])
+        if data is None:
+            raise web.HTTPNotFound()
+        if not coalesce:
+            data = data + os.urandom(16)
+        return web.Response(body=data, content_type='application/octet-stream')
+
+    app = web.Application()
+    app.router.add_get('/img/{name}', serve)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/img/"
+
+
+def load_plugin(config: dict):
+    module = importlib.import_module(f"{PLUGIN_DIR.name}.main")
+    return module.MemeMakerPlugin(SimpleNamespace(), config)
+
+
+async def run_flow(plugin, mode: str, user_id: str, session: str, url: str) -> bool:
+    """执行一次 指令 → 发送图片 流程，返回是否生成成功"""
+    command = {'add': plugin.add_command, 'add1': plugin.add1_command, 'add2': plugin.add2_command}[mode]
+    async for _ in command(FakeEvent(user_id, session, [])):
+        pass
+    # Image.fromURL 只填 file 字段，插件会把它当本地路径读取；显式设置 url 才会走下载流程
+    ok = False
+    async for result in plugin.on_message(FakeEvent(user_id, session, [Image(file=url, url=url)])):
+        ok = ok or result[0] == 'chain'
+    return ok
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+async def main_async(args):
+    config = {}
+    for item in args.config:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value
+
+    fixtures = make_samples()
+    runner, base_url = await start_fixture_server(fixtures, args.coalesce)
+    plugin = load_plugin(config)
+    watchdog = LoopWatchdog(threshold_ms=args.stall_ms)
+    watchdog.start()
+
+    modes = args.modes.split(',')
+    names = list(fixtures)
+    latencies = {mode: [] for mode in modes}
+    failures = {mode: 0 for mode in modes}
+    last_error = None
+    counter = iter(range(args.requests))
+    timeline = []
+    start = time.perf_counter()
+
+    async def worker(worker_id: int):
+        nonlocal last_error
+        for n in counter:
+            mode = modes[n % len(modes)]
+            url = base_url + names[n % len(names)]
+            if not args.coalesce:
+                # 每个流程一个独立URL，并发流程不会共享同一次下载（进而共享同一份图片数据和渲染结果）
+                url += f"?n={n}"
+            session = f"load_group_{n % args.sessions}"
+            flow_start = time.perf_counter()
+            try:
+                ok = await run_flow(plugin, mode, f"load_user_{worker_id}", session, url)
+            except Exception as e:
+                last_error = repr(e)
+                ok = False
+            if ok:
+                latencies[mode].append((time.perf_counter() - flow_start) * 1000)
+            else:
+                failures[mode] += 1
+
+    async def sample_rss():
+        while True:
+            completed = sum(len(v) for v in latencies.values()) + sum(failures.values())
+            recent_lag = max(list(watchdog.lags)[-50:], default=0.0) * 1000
+            timeline.append((time.perf_counter() - start, read_rss_mb(), completed, recent_lag))
+            await asyncio.sleep(args.sample_interval)
+
+    sampler = asyncio.create_task(sample_rss())
+    try:
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    finally:
+        sampler.cancel()
+        watchdog.stop()
+        await plugin.__aexit__(None, None, None)
+        await runner.cleanup()
+
+    elapsed = time.perf_counter() - start
+    total = sum(len(v) for v in latencies.values())
+    if not total:
+        # 全部失败时延迟/吞吐数据没有意义，直接报错而不是输出一张全零的表
+        sys.exit(f"❌ {args.requests} 个流程全部失败（最后一个异常: {last_error or '无，插件返回了错误提示'}），请检查插件日志")
+    print(f"\n{args.requests} 个请求，并发 {args.concurrency}，耗时 {elapsed:.1f}s，成功 {total}，吞吐 {total / elapsed:.2f} 个/s")
+    print(f"{'模式':<6}{'成功':>6}{'失败':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for mode in modes:
+        samples = latencies[mode]
+        p50 = statistics.median(samples) if samples else 0.0
+        print(f"{mode:<6}{len(samples):>6}{failures[mode]:>6}{p50:>10.0f}{percentile(samples, 0.95):>10.0f}"
+              f"{percentile(samples, 0.99):>10.0f}{max(samples, default=0.0):>10.0f}")
+
+    lag = watchdog.stats()
+    print(f"\n事件循环延迟: p50={lag['p50']:.1f}ms p99={lag['p99']:.1f}ms max={lag['max']:.0f}ms，"
+          f"超过 {args.stall_ms}ms 的阻塞 {lag['stalls']} 次")
+
+    print(f"\n{'时间s':>8}{'RSS MB':>10}{'已完成':>8}{'近期最大延迟ms':>16}")
+    for t, rss, completed, recent_lag in timeline:
+        print(f"{t:>8.1f}{rss:>10.1f}{completed:>8}{recent_lag:>16.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=16, help='同时进行的流程数')
+    parser.add_argument('--requests', type=int, default=200, help='总流程数')
+    parser.add_argument('--modes', default='add,add1,add2', help='轮流使用的模式')
+    parser.add_argument('--sessions', type=int, default=4, help='模拟的群（会话）数量')
+    parser.add_argument('--config', action='append', default=[], help='插件配置 key=value（值按JSON解析），可重复')
+    parser.add_argument('--coalesce', action='store_true', help='相同图片使用相同URL且不追加随机字节，允许合并下载和渲染')
+    parser.add_argument('--stall-ms', type=float, default=100, help='事件循环阻塞告警阈值')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='RSS采样间隔（秒）')
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
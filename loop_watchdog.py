@@ -0,0 +1,105 @@
+"""
+事件循环阻塞监控（调试用）
+
+事件循环里的协程每隔 interval 更新一次心跳并记录调度延迟（loop lag）；
+独立的监控线程发现心跳超过阈值没有更新时，说明循环正被同步代码阻塞，
+立即抓取事件循环线程当前的调用栈写入日志，直接定位是哪段代码卡住了整个机器人。
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+try:
+    from astrbot.api import logger
+except ImportError:  # 脱离AstrBot运行（压测脚本）时使用标准logging
+    import logging
+    logger = logging.getLogger("meme_maker")
+
+
+PLUGIN_DIR = str(Path(__file__).resolve().parent)
+
+
+class LoopWatchdog:
+    """测量事件循环延迟，阻塞超过 threshold_ms 时记录调用栈"""
+
+    def __init__(self, threshold_ms: float = 100, interval_ms: float = 20, window: int = 4096):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.lags = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """在事件循环中启动（需要在协程内调用）"""
+        if self.running:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._measure())
+        self._thread = threading.Thread(target=self._monitor, name="meme_maker_watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"[梗图] 事件循环监控已启动，阻塞阈值 {self.threshold * 1000:.0f}ms")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _measure(self):
+        """按固定间隔睡眠，实际唤醒时间与预期的差值就是调度延迟"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self._heartbeat = now
+
+    def _monitor(self):
+        """监控线程：心跳超时即抓取事件循环线程的调用栈，每次阻塞只记录一次"""
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame)
+            in_plugin = any(PLUGIN_DIR in line for line in stack)
+            logger.warn(
+                f"[梗图] ⚠️ 事件循环已阻塞 {blocked * 1000:.0f}ms"
+                f"{'（插件代码）' if in_plugin else ''}，当前调用栈:\n{''.join(stack[-15:])}"
+            )
+
+    def stats(self) -> dict:
+        """调度延迟统计（毫秒）"""
+        samples = sorted(self.lags)
+        if not samples:
+            return {'samples': 0, 'p50': 0.0, 'p99': 0.0, 'max': self.max_lag * 1000, 'stalls': self.stalls}
+        return {
+            'samples': len(samples),
+            'p50': samples[len(samples) // 2] * 1000,
+            'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            'max': self.max_lag * 1000,
+            'stalls': self.stalls,
+        }
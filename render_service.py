@@ -0,0 +1,284 @@
+"""
+本地渲染服务（Unix域套接字）
+
+同一台机器上的多个AstrBot实例共享一个渲染进程：模型只加载一次，线程池只有一个。
+插件配置 render_service_socket 后以客户端模式转发渲染任务，套接字不存在时回退到本进程渲染。
+服务端与插件本地渲染使用同一个调度器（短作业优先 + 老化 + 按会话公平），会话由请求帧携带。
+
+启动服务：
+    python render_service.py --socket /tmp/meme_maker.sock [--workers 4] [--queue 32]
+
+帧格式（网络字节序）：
+    请求: 版本(1字节) 模式(1字节) 长度(4字节) + 会话长度(2字节) + 会话(UTF-8) + 图片数据
+    响应: 版本(1字节) 状态(1字节) 长度(4字节) + PNG数据 / UTF-8错误信息
+"""
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from astrbot.api import logger
+except ImportError:  # 独立运行渲染服务时使用标准logging
+    import logging
+    logger = logging.getLogger("meme_maker")
+
+try:
+    from .scheduler import RenderScheduler, estimate_cost
+except ImportError:  # 作为脚本独立运行
+    from scheduler import RenderScheduler, estimate_cost
+
+
+PROTOCOL_VERSION = 2
+HEADER = struct.Struct('!BBI')
+# 请求数据开头的会话长度
+SESSION_HEADER = struct.Struct('!H')
+
+# 模式编号，顺序固定，不要调整
+MODES = ('add', 'add1', 'add2')
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_BUSY = 2
+
+# 单帧最大长度，避免异常请求占满内存
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class RenderServiceError(Exception):
+    """渲染服务返回错误（渲染失败、服务繁忙、协议错误）"""
+
+
+class RenderServiceUnavailable(RenderServiceError):
+    """渲染服务不可用（套接字不存在、拒绝连接、连接中断），调用方应回退到本进程渲染"""
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    """读取一帧，返回 (第二个头部字段, 数据)"""
+    version, code, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if version != PROTOCOL_VERSION:
+        raise RenderServiceError(f"协议版本不匹配: {version}")
+    if length > MAX_FRAME_SIZE:
+        raise RenderServiceError(f"数据过大: {length} 字节")
+    return code, await reader.readexactly(length)
+
+
+async def _close_writer(writer: asyncio.StreamWriter):
+    """关闭连接并等待关闭完成，对端已断开时忽略错误"""
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, OSError):
+        pass
+
+
+def _write_frame(writer: asyncio.StreamWriter, code: int, payload):
+    writer.write(HEADER.pack(PROTOCOL_VERSION, code, len(payload)))
+    writer.write(payload)
+
+
+def _write_request(writer: asyncio.StreamWriter, mode_code: int, session: str, image_data):
+    """写入请求帧（会话 + 图片数据，分段写入，不拼接图片数据）"""
+    session_bytes = session.encode('utf-8')[:0xFFFF]
+    prefix = SESSION_HEADER.pack(len(session_bytes)) + session_bytes
+    writer.write(HEADER.pack(PROTOCOL_VERSION, mode_code, len(prefix) + len(image_data)))
+    writer.write(prefix)
+    writer.write(image_data)
+
+
+def _split_request(payload: bytes):
+    """拆分请求数据，返回 (会话, 图片数据的memoryview)"""
+    if len(payload) < SESSION_HEADER.size:
+        raise RenderServiceError("请求数据不完整")
+    (session_len,) = SESSION_HEADER.unpack_from(payload)
+    start = SESSION_HEADER.size + session_len
+    if len(payload) < start:
+        raise RenderServiceError("请求数据不完整")
+    session = payload[SESSION_HEADER.size:start].decode('utf-8', 'replace')
+    return session, memoryview(payload)[start:]
+
+
+def claim_socket_path(socket_path: str):
+    """
+    启动服务前检查套接字路径：已有服务在监听时抛出 RenderServiceError，避免抢占正在运行的服务
+    上次异常退出残留的套接字文件会被清理
+    """
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except PermissionError as e:
+        raise RenderServiceError(f"无权访问 {socket_path}（{e}），请使用其他 --socket 路径") from e
+    except (ConnectionError, FileNotFoundError):
+        # 没有服务在监听，清理残留文件后继续启动
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return
+    finally:
+        probe.close()
+    raise RenderServiceError(f"已有渲染服务在监听 {socket_path}，请先停止它或使用其他 --socket 路径")
+
+
+class RenderClient:
+    """渲染服务客户端（每个任务一个短连接，Unix套接字建连开销可忽略）"""
+
+    def __init__(self, socket_path: str, timeout: float = 120):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    @staticmethod
+    def supported() -> bool:
+        """当前平台是否支持Unix域套接字（Windows不支持）"""
+        return hasattr(asyncio, 'open_unix_connection')
+
+    async def render(self, mode: str, image_data: bytes, session: str = '') -> bytes:
+        """
+        提交渲染任务并等待结果，session 用于服务端按会话公平调度
+        服务不可用时抛出 RenderServiceUnavailable，渲染失败/繁忙时抛出 RenderServiceError
+        """
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        except OSError as e:
+            # 套接字不存在、拒绝连接、无权限访问（共享主机上常见）等都回退到本进程渲染
+            raise RenderServiceUnavailable(str(e)) from e
+        try:
+            _write_request(writer, MODES.index(mode), session, image_data)
+            await writer.drain()
+            status, payload = await asyncio.wait_for(_read_frame(reader), self.timeout)
+        except asyncio.TimeoutError as e:
+            # 服务仍在渲染，不回退到本进程（否则同一任务会被渲染两次）
+            raise RenderServiceError(f"渲染服务超时（{self.timeout:g}秒内未返回结果）") from e
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            raise RenderServiceUnavailable(f"连接中断: {e}") from e
+        finally:
+            await _close_writer(writer)
+
+        if status == STATUS_OK:
+            return payload
+        message = payload.decode('utf-8', 'replace')
+        if status == STATUS_BUSY:
+            raise RenderServiceError(f"渲染服务繁忙，请稍后重试（{message}）")
+        raise RenderServiceError(message)
+
+
+class RenderServer:
+    """
+    渲染服务端：一个常驻线程池 + 调度器 + 有界队列
+    任务按估算成本和会话排队（与插件本地渲染相同），排队+执行中的任务超过 workers + queue_size 时直接返回繁忙
+    """
+
+    def __init__(self, renderer, socket_path: str, workers: int, queue_size: int,
+                 aging: float = 4.0, session_penalty: float = 1.0):
+        self.renderer = renderer
+        self.socket_path = socket_path
+        self.workers = workers
+        self.max_pending = workers + queue_size
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="meme_render")
+        self.scheduler = RenderScheduler(self.executor, workers, aging=aging, session_penalty=session_penalty)
+
+    async def serve_forever(self):
+        claim_socket_path(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        logger.info(f"[渲染服务] 已启动: {self.socket_path}，工作线程数: {self.workers}，最大排队: {self.max_pending - self.workers}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """一个连接可以连续提交多个任务，按顺序返回结果"""
+        try:
+            while True:
+                try:
+                    mode_code, payload = await _read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                session, image_data = _split_request(payload)
+                status, payload = await self._render(mode_code, session, image_data)
+                _write_frame(writer, status, payload)
+                await writer.drain()
+        except (ConnectionError, RenderServiceError) as e:
+            logger.warn(f"[渲染服务] 连接异常: {e}")
+        finally:
+            await _close_writer(writer)
+
+    async def _render(self, mode_code: int, session: str, image_data):
+        """返回 (状态, 数据)"""
+        if mode_code >= len(MODES):
+            return STATUS_ERROR, f"未知的处理模式编号: {mode_code}".encode()
+        if self.pending >= self.max_pending:
+            return STATUS_BUSY, f"排队任务已满 ({self.pending})".encode()
+
+        self.pending += 1
+        try:
+            mode = MODES[mode_code]
+            cost = estimate_cost(mode, image_data)
+            result = await self.scheduler.submit(session, cost, self.renderer.render, mode, image_data)
+            return STATUS_OK, result
+        except Exception as e:
+            logger.error(f"[渲染服务] 渲染失败: {e}")
+            return STATUS_ERROR, str(e).encode()
+        finally:
+            self.pending -= 1
+
+
+def main():
+    import logging
+    from renderer import MemeRenderer
+    from thread_budget import PROFILES, apply_thread_budget, plan_thread_budget
+
+    parser = argparse.ArgumentParser(description="梗图本地渲染服务")
+    parser.add_argument('--socket', default='/tmp/meme_maker.sock', help='Unix套接字路径')
+    parser.add_argument('--workers', type=int, default=0, help='工作线程数，默认按线程配置计算')
+    parser.add_argument('--thread-profile', default='throughput', choices=PROFILES, help='线程配置（见 thread_budget.py）')
+    parser.add_argument('--queue', type=int, default=32, help='最大排队任务数（不含执行中）')
+    parser.add_argument('--mode1-engine', default='pillow', help='/add 合成引擎: pillow / cv2')
+    parser.add_argument('--mode2-engine', default='pillow', help='/add1 合成引擎: pillow / cv2')
+    parser.add_argument('--face-detector', default='dnn', help='/add2 人脸检测后端: dnn / dlib')
+    parser.add_argument('--dlib-upsample', type=int, default=0)
+    parser.add_argument('--dlib-max-side', type=int, default=800)
+    parser.add_argument('--scheduler-aging', type=float, default=4.0, help='调度老化系数，越大越偏向小图片')
+    parser.add_argument('--scheduler-session-penalty', type=float, default=1.0, help='同一会话每个积压任务推迟的秒数')
+    parser.add_argument('--input-cache-mb', type=int, default=128, help='输入图片缓存大小（MB），0表示不缓存')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    # 先检查套接字路径再加载模型，已有服务在运行时立即退出
+    try:
+        claim_socket_path(args.socket)
+    except RenderServiceError as e:
+        logger.error(f"[渲染服务] 启动失败: {e}")
+        sys.exit(1)
+    budget = plan_thread_budget(args.thread_profile, workers=args.workers)
+    apply_thread_budget(budget)
+    renderer = MemeRenderer(
+        Path(__file__).parent,
+        mode1_engine=args.mode1_engine,
+        mode2_engine=args.mode2_engine,
+        face_detector=args.face_detector,
+        dlib_upsample=args.dlib_upsample,
+        dlib_max_side=args.dlib_max_side,
+        input_cache_mb=args.input_cache_mb,
+    )
+    server = RenderServer(renderer, args.socket, budget.workers, args.queue,
+                          aging=args.scheduler_aging, session_penalty=args.scheduler_session_penalty)
+    try:
+        asyncio.run(server.serve_forever())
+    except RenderServiceError as e:
+        logger.error(f"[渲染服务] 启动失败: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        logger.info("[渲染服务] 已停止")
+
+
+if __name__ == '__main__':
+    main()
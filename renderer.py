@@ -0,0 +1,979 @@
+"""
+梗图渲染核心（不依赖AstrBot）
+
+插件、渲染服务、基准测试等都通过 MemeRenderer 复用同一套渲染逻辑
+"""
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+from PIL import Image as PILImage, ImageOps
+
+try:
+    from astrbot.api import logger
+except ImportError:  # 脱离AstrBot运行（基准测试/脚本）时使用标准logging
+    import logging
+    logger = logging.getLogger("meme_maker")
+
+try:
+    import dlib
+except ImportError:  # dlib为可选依赖，未安装时dlib检测后端回退到DNN
+    dlib = None
+
+
+# 模板和圣诞帽文件名（位于插件目录）
+TEMPLATE_FILE = "template.png"
+TEMPLATE2_FILE = "template2.png"
+HAT_FILE = "christmas_hat.png"
+
+# 输入图片最大边长，超过时先缩小
+MAX_DIMENSION = 2000
+
+# 模式1模板中用户图片的目标区域 (x, y, 宽, 高)
+MODE1_TARGET = (125, 105, 400, 400)
+
+# 可选的合成引擎
+ENGINES = ('pillow', 'cv2')
+
+# 可选的人脸检测后端（dnn: DNN→Anime级联→Haar；dlib: HOG+5点关键点→Anime级联→Haar）
+FACE_DETECTORS = ('dnn', 'dlib')
+
+
+def _decode_cv2(image_data) -> np.ndarray:
+    """
+    使用cv2解码图片（保留Alpha通道），统一为8位BGR/BGRA
+    无法解码（如GIF）时返回None，由调用方回退到Pillow
+    """
+    img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8)
+    elif img.dtype != np.uint8:
+        return None
+    if img.ndim == 2 or img.shape[2] == 1:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img
+
+
+def _resize_cv2(img: np.ndarray, width: int, height: int) -> np.ndarray:
+    """缩小时使用INTER_AREA（抗锯齿），放大时使用INTER_LINEAR"""
+    if width < img.shape[1] and height < img.shape[0]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    return cv2.resize(img, (width, height), interpolation=interpolation)
+
+
+def _cover_fit_cv2(img: np.ndarray, target_width: int, target_height: int) -> np.ndarray:
+    """
+    等比缩放并居中裁剪到目标尺寸（与Pillow路径的裁剪填充一致）
+    先在源图上裁出可见区域（视图，无拷贝），再只缩放这一部分
+    """
+    h, w = img.shape[:2]
+    if w <= 0 or h <= 0:
+        raise ValueError(f"用户图片尺寸无效: {w}x{h}")
+    scale = max(target_width / w, target_height / h)
+    src_w = min(w, max(1, round(target_width / scale)))
+    src_h = min(h, max(1, round(target_height / scale)))
+    src_x = (w - src_w) // 2
+    src_y = (h - src_h) // 2
+    return _resize_cv2(img[src_y:src_y + src_h, src_x:src_x + src_w], target_width, target_height)
+
+
+def _blend_into(dst: np.ndarray, src_bgr: np.ndarray, alpha: np.ndarray):
+    """按alpha将src_bgr原地混合到dst的前三个通道（uint16整数运算）"""
+    a = alpha[..., None].astype(np.uint16)
+    mixed = src_bgr.astype(np.uint16) * a
+    mixed += dst[..., :3].astype(np.uint16) * (255 - a)
+    mixed += 127
+    mixed //= 255
+    dst[..., :3] = mixed
+
+
+def _encode_png_cv2(img: np.ndarray):
+    """
+    编码为PNG，直接返回编码缓冲区的memoryview（避免tobytes再拷贝一次）
+    """
+    # 压缩级别0-9，6是平衡值
+    is_success, buffer = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+    if not is_success:
+        raise ValueError("图片编码失败喵")
+    return memoryview(buffer.reshape(-1))
+
+
+# EXIF方向标签
+EXIF_ORIENTATION = 0x0112
+
+
+def _exif_orientation(image_data) -> int:
+    """只读取文件头中的EXIF方向（1-8），没有或读取失败时返回1"""
+    try:
+        with PILImage.open(io.BytesIO(image_data)) as image:
+            return image.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return 1
+
+
+def _apply_orientation(img: np.ndarray, orientation: int) -> np.ndarray:
+    """按EXIF方向摆正图片（与cv2.IMREAD_COLOR / ImageOps.exif_transpose的结果一致）"""
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.transpose(img)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(img), -1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+
+def _decode_pillow(image_data) -> np.ndarray:
+    """cv2无法解码的格式（如GIF）使用Pillow解码，统一为8位BGR/BGRA"""
+    try:
+        with PILImage.open(io.BytesIO(image_data)) as image:
+            image = ImageOps.exif_transpose(image)
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            array = np.asarray(image.convert('RGBA' if has_alpha else 'RGB'))
+    except Exception as e:
+        raise ValueError("无法解码图片数据") from e
+    return cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA if has_alpha else cv2.COLOR_RGB2BGR)
+
+
+def _to_pil(img: np.ndarray) -> PILImage.Image:
+    """工作图片（BGR/BGRA）转为Pillow图片（RGB/RGBA）"""
+    if img.shape[2] == 4:
+        return PILImage.fromarray(cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA))
+    return PILImage.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+
+class WorkingImage(NamedTuple):
+    # 解码、摆正并缩小后的图片（8位BGR/BGRA，只读）
+    image: np.ndarray
+    # 对应的灰度图（只读）
+    gray: np.ndarray
+    nbytes: int
+
+
+def input_digest(image_data) -> bytes:
+    """输入图片的内容哈希（输入缓存的key；插件合并相同请求时也用它，只需计算一次）"""
+    return hashlib.blake2b(image_data, digest_size=16).digest()
+
+
+def _decode_working_image(image_data) -> WorkingImage:
+    """
+    解码为三个模式共用的工作图片：8位BGR/BGRA、按EXIF方向摆正、最大边不超过 MAX_DIMENSION，并附带灰度图
+    返回的数组是只读的（可能被缓存共享），需要修改时先copy
+    """
+    if not image_data:
+        raise ValueError("图片数据为空")
+    img = _decode_cv2(image_data)
+    if img is None:
+        img = _decode_pillow(image_data)
+    else:
+        img = _apply_orientation(img, _exif_orientation(image_data))
+
+    # 🔥 优化：如果图片过大，先缩小到合理尺寸（最大边2000像素）以避免卡死和内存溢出
+    h, w = img.shape[:2]
+    if max(w, h) > MAX_DIMENSION:
+        scale = MAX_DIMENSION / max(w, h)
+        new_w = max(1, int(w * scale))
+        new_h = max(1, int(h * scale))
+        logger.info(f"[梗图] 图片过大 ({w}x{h})，先缩小到 {new_w}x{new_h} 以优化性能")
+        # 使用INTER_LINEAR而不是INTER_AREA，速度更快
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+    img.flags.writeable = False
+    gray.flags.writeable = False
+    return WorkingImage(img, gray, img.nbytes + gray.nbytes)
+
+
+class WorkingImageCache:
+    """
+    工作图片缓存（按输入内容哈希，LRU淘汰，按字节数限额，线程安全）
+    用户常对同一张图依次尝试 /add、/add1、/add2，后续指令直接复用已解码、已缩小的图片
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: bytes, entry: WorkingImage):
+        # 单张超过总限额的图片不缓存，避免清空整个缓存
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._entries[key] = entry
+            self.bytes += entry.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class MemeRenderer:
+    """梗图渲染器：加载模板/模型，提供各模式的同步渲染函数（线程安全）"""
+
+    def __init__(self, base_dir: Path, mode1_engine: str = 'pillow', mode2_engine: str = 'pillow',
+                 face_detector: str = 'dnn', dlib_upsample: int = 0, dlib_max_side: int = 800,
+                 input_cache_mb: int = 128):
+        base_dir = Path(base_dir)
+        # 模板1路径（原有模板）
+        self.template_path = base_dir / TEMPLATE_FILE
+        # 模板2路径（新增透明底模板）
+        self.template2_path = base_dir / TEMPLATE2_FILE
+        # 圣诞帽路径
+        self.hat_path = base_dir / HAT_FILE
+        # 模型目录路径
+        self.models_dir = base_dir / "models"
+
+        # 每个模式使用的合成引擎
+        self.mode1_engine = self._check_engine(mode1_engine, "模式1")
+        self.mode2_engine = self._check_engine(mode2_engine, "模式2")
+
+        # 圣诞帽人脸检测后端
+        if face_detector not in FACE_DETECTORS:
+            logger.warn(f"[梗图] 人脸检测后端 {face_detector!r} 无效，使用 dnn")
+            face_detector = 'dnn'
+        self.face_detector = face_detector
+        # dlib HOG检测的上采样次数（越大越能检出小脸，耗时约x4/次）和检测前灰度图的最大边长
+        self.dlib_upsample = max(0, int(dlib_upsample))
+        self.dlib_max_side = max(160, int(dlib_max_side))
+        self.dlib_landmarks_path = self.models_dir / "shape_predictor_5_face_landmarks.dat"
+        self._dlib_local = threading.local()
+
+        # cv2引擎使用的模板数组（首次使用时加载）
+        self._cv2_templates = {}
+        self._cv2_templates_lock = threading.Lock()
+
+        # 三个模式共用的输入图片缓存（0表示不缓存）
+        input_cache_mb = max(0, int(input_cache_mb))
+        self.input_cache = WorkingImageCache(input_cache_mb * 1024 * 1024) if input_cache_mb else None
+
+        # 检查模板是否存在
+        if not self.template_path.exists():
+            logger.error(f"[梗图] ❌ 模板1不存在: {self.template_path}")
+        else:
+            logger.info(f"[梗图] ✅ 模板1加载成功: {self.template_path}")
+
+        if not self.template2_path.exists():
+            logger.error(f"[梗图] ❌ 模板2不存在: {self.template2_path}")
+        else:
+            logger.info(f"[梗图] ✅ 模板2加载成功: {self.template2_path}")
+
+        # 预加载人脸检测模型（避免每次处理时重复加载）
+        self.dnn_net = None
+        self.anime_cascade = None
+        self.haar_cascade = None
+        self.hat_img = None
+
+        # 加载DNN模型
+        prototxt_path = self.models_dir / "deploy.prototxt"
+        caffemodel_path = self.models_dir / "res10_300x300_ssd_iter_140000.caffemodel"
+        if prototxt_path.exists() and caffemodel_path.exists():
+            try:
+                self.dnn_net = cv2.dnn.readNetFromCaffe(str(prototxt_path), str(caffemodel_path))
+                logger.info(f"[梗图] ✅ DNN人脸检测模型加载成功")
+            except Exception as e:
+                logger.error(f"[梗图] ❌ DNN模型加载失败: {e}")
+        else:
+            logger.info("[梗图] ℹ️ DNN模型文件不存在，将跳过DNN检测")
+
+        # 加载Anime级联分类器
+        anime_cascade_path = self.models_dir / "lbpcascade_animeface.xml"
+        if anime_cascade_path.exists():
+            try:
+                self.anime_cascade = cv2.CascadeClassifier(str(anime_cascade_path))
+                if self.anime_cascade.empty():
+                    logger.error(f"[梗图] ❌ Anime级联模型加载失败")
+                    self.anime_cascade = None
+                else:
+                    logger.info(f"[梗图] ✅ Anime级联模型加载成功")
+            except Exception as e:
+                logger.error(f"[梗图] ❌ Anime级联模型加载失败: {e}")
+        else:
+            logger.info("[梗图] ℹ️ Anime级联模型文件不存在，将跳过Anime检测")
+
+        # 加载Haar级联分类器（OpenCV内置）
+        try:
+            cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+            self.haar_cascade = cv2.CascadeClassifier(cascade_path)
+            if self.haar_cascade.empty():
+                logger.error(f"[梗图] ❌ Haar级联模型加载失败")
+                self.haar_cascade = None
+            else:
+                logger.info(f"[梗图] ✅ Haar级联模型加载成功")
+        except Exception as e:
+            logger.error(f"[梗图] ❌ Haar级联模型加载失败: {e}")
+
+        # 预加载圣诞帽图片（使用cv2.imdecode支持Unicode路径，解决Windows中文路径问题）
+        if self.hat_path.exists():
+            try:
+                # 使用np.fromfile + cv2.imdecode读取，支持Unicode路径（Windows中文路径兼容）
+                img_array = np.fromfile(str(self.hat_path), dtype=np.uint8)
+                self.hat_img = cv2.imdecode(img_array, cv2.IMREAD_UNCHANGED)
+                if self.hat_img is None:
+                    logger.error(f"[梗图] ❌ 圣诞帽图片加载失败（文件可能损坏或格式不支持）")
+                    self.hat_img = None
+                elif len(self.hat_img.shape) < 3 or self.hat_img.shape[2] != 4:
+                    logger.error(f"[梗图] ❌ 圣诞帽图片不包含Alpha通道，需要RGBA格式的PNG图片")
+                    self.hat_img = None
+                else:
+                    logger.info(f"[梗图] ✅ 圣诞帽图片加载成功（支持Unicode路径）")
+            except Exception as e:
+                logger.error(f"[梗图] ❌ 圣诞帽图片加载失败: {e}")
+                self.hat_img = None
+        else:
+            logger.info("[梗图] ℹ️ 圣诞帽图片不存在")
+
+        if self.face_detector == 'dlib':
+            if dlib is None:
+                logger.error("[梗图] ❌ 已选择dlib人脸检测，但dlib未安装，将使用DNN检测")
+            elif not self.dlib_landmarks_path.exists():
+                logger.info("[梗图] ℹ️ dlib关键点模型不存在，将只使用HOG人脸框（帽子不随头部倾斜旋转）")
+            else:
+                logger.info("[梗图] ✅ dlib HOG人脸检测 + 5点关键点模型已启用")
+
+    @staticmethod
+    def _check_engine(engine: str, label: str) -> str:
+        """校验引擎名称，未知值回退到pillow"""
+        if engine not in ENGINES:
+            logger.warn(f"[梗图] {label}合成引擎 {engine!r} 无效，使用 pillow")
+            return 'pillow'
+        return engine
+
+    def render(self, mode: str, user_image_data: bytes, digest: bytes = None):
+        """
+        按指令模式渲染（'add' / 'add1' / 'add2'）
+        digest 为调用方已计算的 input_digest(user_image_data)，省去重复哈希
+        返回PNG字节数据（bytes或memoryview）
+        """
+        if mode == 'add':
+            return self.render_mode1(user_image_data, digest)
+        elif mode == 'add1':
+            return self.render_mode2(user_image_data, digest)
+        elif mode == 'add2':
+            return self.render_mode3(user_image_data, digest)
+        raise ValueError(f"未知的处理模式: {mode}")
+
+    def _load_template_cv2(self, key: str) -> dict:
+        """
+        加载并缓存cv2引擎使用的模板数组（线程安全，只加载一次）
+        模板2额外预计算 预乘颜色 和 1-alpha，每次合成只剩一次乘加
+        """
+        cached = self._cv2_templates.get(key)
+        if cached is not None:
+            return cached
+        with self._cv2_templates_lock:
+            cached = self._cv2_templates.get(key)
+            if cached is not None:
+                return cached
+            path = self.template_path if key == 'mode1' else self.template2_path
+            # 使用np.fromfile + cv2.imdecode读取，支持Unicode路径
+            template = _decode_cv2(np.fromfile(str(path), dtype=np.uint8))
+            if template is None:
+                raise ValueError(f"模板解码失败: {path}")
+            cached = {'image': template}
+            if key == 'mode2':
+                if template.shape[2] != 4:
+                    template = cv2.cvtColor(template, cv2.COLOR_BGR2BGRA)
+                alpha = template[..., 3:4].astype(np.uint16)
+                cached['premultiplied'] = template[..., :3].astype(np.uint16) * alpha
+                cached['inv_alpha'] = 255 - alpha
+                cached['alpha'] = alpha
+                cached['size'] = (template.shape[1], template.shape[0])
+            self._cv2_templates[key] = cached
+            return cached
+
+    def _working_image(self, user_image_data: bytes, digest: bytes = None) -> WorkingImage:
+        """
+        获取输入图片的工作副本（解码+摆正+缩小）
+        同一张图再次使用任意模式时直接命中缓存，跳过解码和缩小
+        """
+        if self.input_cache is None:
+            return _decode_working_image(user_image_data)
+        key = digest or input_digest(user_image_data)
+        working = self.input_cache.get(key)
+        if working is not None:
+            logger.info(f"[梗图] ♻️ 命中输入图片缓存，跳过解码和缩小 ({working.image.shape[1]}x{working.image.shape[0]})")
+            return working
+        working = _decode_working_image(user_image_data)
+        self.input_cache.put(key, working)
+        return working
+
+    def render_mode1(self, user_image_data: bytes, digest: bytes = None):
+        """
+        模式1：将用户图片合成到模板上（智能裁剪填充）
+        原有的 /add 功能
+        """
+        user_image = self._working_image(user_image_data, digest).image
+        if self.mode1_engine == 'cv2':
+            return self._render_mode1_cv2(user_image)
+        return self._render_mode1_pillow(user_image)
+
+    def _render_mode1_pillow(self, working_image: np.ndarray) -> bytes:
+        """模式1 Pillow引擎"""
+        # 打开模板，工作图片转为Pillow的RGB/RGBA图片
+        template = None
+        user_image = None
+        try:
+            template = PILImage.open(str(self.template_path))
+            user_image = _to_pil(working_image)
+
+            logger.info(f"[梗图] 模板尺寸: {template.size}, 用户图片尺寸: {user_image.size}")
+
+            # 定义目标区域
+            target_x, target_y, target_width, target_height = MODE1_TARGET
+
+            # 裁剪填充方案
+            if user_image.width <= 0 or user_image.height <= 0:
+                raise ValueError(f"用户图片尺寸无效: {user_image.size}")
+            scale_x = target_width / user_image.width
+            scale_y = target_height / user_image.height
+            scale = max(scale_x, scale_y)
+
+            new_width = int(user_image.width * scale)
+            new_height = int(user_image.height * scale)
+
+            # 使用BILINEAR算法，速度更快
+            user_image = user_image.resize((new_width, new_height), PILImage.Resampling.BILINEAR)
+
+            crop_x = (new_width - target_width) // 2
+            crop_y = (new_height - target_height) // 2
+
+            user_image = user_image.crop((
+                crop_x,
+                crop_y,
+                crop_x + target_width,
+                crop_y + target_height
+            ))
+
+            # 粘贴到模板
+            if user_image.mode == 'RGBA':
+                template.paste(user_image, (target_x, target_y), user_image)
+            else:
+                template.paste(user_image, (target_x, target_y))
+
+            # 保存结果，优化输出大小
+            output = io.BytesIO()
+            # 如果结果图片过大，使用优化参数压缩
+            if max(template.size) > 2000:
+                template.save(output, format='PNG', optimize=True, compress_level=6)
+            else:
+                template.save(output, format='PNG', optimize=True)
+
+            # getvalue直接共享BytesIO内部缓冲区，避免seek+read再拷贝一次
+            return output.getvalue()
+        finally:
+            # 显式关闭资源，避免内存泄漏
+            if template:
+                template.close()
+            if user_image:
+                user_image.close()
+
+    def _render_mode1_cv2(self, user_image: np.ndarray):
+        """模式1 cv2/NumPy引擎：一次INTER_AREA缩放 + 模板ROI原地写入"""
+        canvas = self._load_template_cv2('mode1')['image'].copy()
+        target_x, target_y, target_width, target_height = MODE1_TARGET
+        logger.info(f"[梗图] 模板尺寸: {canvas.shape[1]}x{canvas.shape[0]}, 用户图片尺寸: {user_image.shape[1]}x{user_image.shape[0]}（cv2引擎）")
+
+        patch = _cover_fit_cv2(user_image, target_width, target_height)
+
+        # 与Pillow的paste一致：超出模板的部分直接丢弃
+        roi = canvas[target_y:target_y + target_height, target_x:target_x + target_width]
+        patch = patch[:roi.shape[0], :roi.shape[1]]
+
+        if patch.shape[2] == 4:
+            alpha = patch[..., 3]
+            _blend_into(roi, patch[..., :3], alpha)
+            if roi.shape[2] == 4:
+                _blend_into(roi[..., 3:4], alpha[..., None], alpha)
+        else:
+            roi[..., :3] = patch
+            if roi.shape[2] == 4:
+                roi[..., 3] = 255
+
+        return _encode_png_cv2(canvas)
+
+    def render_mode2(self, user_image_data: bytes, digest: bytes = None):
+        """
+        模式2：将透明底模板覆盖在用户图片上
+        新增的 /add1 功能
+        """
+        user_image = self._working_image(user_image_data, digest).image
+        if self.mode2_engine == 'cv2':
+            return self._render_mode2_cv2(user_image)
+        return self._render_mode2_pillow(user_image)
+
+    def _render_mode2_pillow(self, working_image: np.ndarray) -> bytes:
+        """
+        模式2 Pillow引擎
+
+        策略：
+        1. 将用户图片等比缩放到模板尺寸（1990x1918）
+        2. 将模板（透明底）叠加在用户图片上
+        """
+        # 打开用户图片和模板
+        user_image = None
+        template = None
+        try:
+            user_image = _to_pil(working_image)
+            template = PILImage.open(str(self.template2_path))
+
+            logger.info(f"[梗图Mode2] 用户图片尺寸: {user_image.size}, 模板尺寸: {template.size}")
+
+            # 转换用户图片为 RGBA 模式（支持透明度）
+            if user_image.mode != 'RGBA':
+                user_image = user_image.convert('RGBA')
+
+            # 确保模板也是 RGBA 模式
+            if template.mode != 'RGBA':
+                template = template.convert('RGBA')
+
+            # 获取模板尺寸
+            template_width, template_height = template.size
+
+            # 🔥 智能缩放用户图片到模板尺寸（保持比例，裁剪填充）
+            if user_image.width <= 0 or user_image.height <= 0:
+                raise ValueError(f"用户图片尺寸无效: {user_image.size}")
+            if template_width <= 0 or template_height <= 0:
+                raise ValueError(f"模板尺寸无效: {template.size}")
+            scale_x = template_width / user_image.width
+            scale_y = template_height / user_image.height
+            scale = max(scale_x, scale_y)  # 取大值确保填满
+
+            new_width = int(user_image.width * scale)
+            new_height = int(user_image.height * scale)
+
+            logger.info(f"[梗图Mode2] 缩放比例: {scale:.2f}, 缩放后尺寸: {new_width}x{new_height}")
+
+            # 缩放用户图片，使用BILINEAR算法，速度更快
+            user_image = user_image.resize((new_width, new_height), PILImage.Resampling.BILINEAR)
+
+            # 居中裁剪到模板尺寸
+            crop_x = (new_width - template_width) // 2
+            crop_y = (new_height - template_height) // 2
+
+            user_image = user_image.crop((
+                crop_x,
+                crop_y,
+                crop_x + template_width,
+                crop_y + template_height
+            ))
+
+            logger.info(f"[梗图Mode2] 最终用户图片尺寸: {user_image.size}")
+
+            # 🔥 将模板叠加到用户图片上（透明底会显示底层用户图片）
+            # 使用 alpha_composite 进行透明叠加（返回新图像，无需先copy）
+            result = PILImage.alpha_composite(user_image, template)
+
+            # 保存结果，优化输出大小
+            output = io.BytesIO()
+            # 如果结果图片过大，使用优化参数压缩
+            if max(result.size) > 2000:
+                result.save(output, format='PNG', optimize=True, compress_level=6)
+            else:
+                result.save(output, format='PNG', optimize=True)
+
+            logger.info("[梗图Mode2] 图片保存完成")
+            # getvalue直接共享BytesIO内部缓冲区，避免seek+read再拷贝一次
+            return output.getvalue()
+        finally:
+            # 显式关闭资源，避免内存泄漏
+            if user_image:
+                user_image.close()
+            if template:
+                template.close()
+
+    def _render_mode2_cv2(self, user_image: np.ndarray):
+        """
+        模式2 cv2/NumPy引擎
+        out = 模板预乘颜色 + 用户颜色 * (1 - 模板alpha)，整数运算并原地累加
+        """
+        template = self._load_template_cv2('mode2')
+        template_width, template_height = template['size']
+        logger.info(f"[梗图Mode2] 用户图片尺寸: {user_image.shape[1]}x{user_image.shape[0]}, 模板尺寸: {template_width}x{template_height}（cv2引擎）")
+
+        user_image = _cover_fit_cv2(user_image, template_width, template_height)
+
+        if user_image.shape[2] == 4:
+            # 用户图片自带透明度：按alpha_composite公式计算输出alpha和颜色
+            user_weight = user_image[..., 3:4].astype(np.uint16) * template['inv_alpha'] // 255
+            out_alpha = template['alpha'] + user_weight
+            color = template['premultiplied'] + user_image[..., :3].astype(np.uint16) * user_weight
+            color = (color + out_alpha // 2) // np.maximum(out_alpha, 1)
+            result = np.concatenate([color, out_alpha], axis=2).astype(np.uint8)
+        else:
+            # 不透明用户图片：结果也不透明，输出BGR即可
+            mixed = user_image.astype(np.uint16)
+            mixed *= template['inv_alpha']
+            mixed += template['premultiplied']
+            mixed += 127
+            mixed //= 255
+            result = mixed.astype(np.uint8)
+
+        logger.info("[梗图Mode2] 图片保存完成")
+        return _encode_png_cv2(result)
+
+    def _detect_faces(self, img, gray, h, w, use_dnn: bool = True):
+        """
+        检测人脸 - 使用预加载的模型
+        use_dnn=False 时跳过较重的DNN检测（dlib已检测过真人脸）
+        返回人脸列表
+        """
+        faces = []
+
+        # 3.1 优先尝试 DNN 真人人脸检测
+        if use_dnn and self.dnn_net is not None:
+            try:
+                logger.info("[圣诞帽] 使用预加载的 DNN 人脸检测")
+                blob = cv2.dnn.blobFromImage(
+                    cv2.resize(img, (300, 300)),
+                    1.0,
+                    (300, 300),
+                    (104.0, 177.0, 123.0)
+                )
+                self.dnn_net.setInput(blob)
+                detections = self.dnn_net.forward()
+
+                for i in range(detections.shape[2]):
+                    confidence = detections[0, 0, i, 2]
+                    if confidence < 0.5:
+                        continue
+                    box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
+                    (x1_d, y1_d, x2_d, y2_d) = box.astype("int")
+                    x_d = max(0, x1_d)
+                    y_d = max(0, y1_d)
+                    w_d = min(w, x2_d) - x_d
+                    h_d = min(h, y2_d) - y_d
+                    if w_d > 0 and h_d > 0:
+                        faces.append((x_d, y_d, w_d, h_d))
+
+                if faces:
+                    logger.info(f"[圣诞帽] DNN 检测到 {len(faces)} 张人脸: {faces}")
+            except Exception as dnn_e:
+                logger.error(f"[圣诞帽] DNN 人脸检测失败: {dnn_e}", exc_info=True)
+
+        # 3.2 若 DNN 未检测到，再尝试 Anime 级联检测
+        if not faces and self.anime_cascade is not None:
+            try:
+                logger.info("[圣诞帽] 使用预加载的 Anime 级联人脸检测")
+                # 针对较小动漫脸，放宽最小尺寸和邻居参数
+                min_face = max(int(min(w, h) * 0.03), 20)
+                faces_anime = self.anime_cascade.detectMultiScale(
+                    gray,
+                    scaleFactor=1.1,
+                    minNeighbors=3,
+                    flags=cv2.CASCADE_SCALE_IMAGE,
+                    minSize=(min_face, min_face)
+                )
+                if len(faces_anime) > 0:
+                    faces = list(faces_anime)
+                    logger.info(f"[圣诞帽] Anime 级联检测到 {len(faces)} 张人脸: {faces}")
+            except Exception as anime_e:
+                logger.error(f"[圣诞帽] Anime 级联人脸检测失败: {anime_e}", exc_info=True)
+
+        # 3.3 如前两种仍未检测到，则回退到 Haar 检测
+        if not faces and self.haar_cascade is not None:
+            try:
+                logger.info("[圣诞帽] 使用预加载的 Haar 人脸检测作为回退方案")
+                # 允许识别较小人脸（约为图像宽/高的 5% 起）
+                min_face_w = max(int(w * 0.05), 24)
+                min_face_h = max(int(h * 0.05), 24)
+                faces_haar = self.haar_cascade.detectMultiScale(
+                    gray,
+                    scaleFactor=1.1,
+                    minNeighbors=3,
+                    flags=cv2.CASCADE_SCALE_IMAGE,
+                    minSize=(min_face_w, min_face_h)
+                )
+                faces = list(faces_haar) if len(faces_haar) > 0 else []
+            except Exception as haar_e:
+                logger.error(f"[圣诞帽] Haar 人脸检测失败: {haar_e}", exc_info=True)
+
+        # 3.4 如果仍然没有检测到人脸，则兜底：以图片中心区域作为"人脸区域"
+        if not faces:
+            logger.warn("[圣诞帽] 未检测到人脸，启用兜底方案：使用图片中心区域戴帽子（适配动漫头像/其他生物）")
+            fake_w = int(w * 0.5)
+            fake_h = int(h * 0.5)
+            x_fake = (w - fake_w) // 2
+            y_fake = int(h * 0.15)
+            faces.append((x_fake, y_fake, fake_w, fake_h))
+
+        return faces
+
+    def _detect_faces_dlib(self, gray):
+        """
+        dlib HOG 人脸检测 + 5点关键点（模型存在时）
+        在缩小后的灰度图上检测，坐标换算回原图
+        返回 [(x, y, w, h, 两眼中心或None)]，dlib未安装时返回None
+        """
+        models = self._get_dlib_models()
+        if models is None:
+            return None
+        detector, predictor = models
+
+        h, w = gray.shape[:2]
+        scale = min(1.0, self.dlib_max_side / max(w, h))
+        small = gray if scale >= 1.0 else cv2.resize(
+            gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA
+        )
+
+        faces = []
+        for rect in detector(small, self.dlib_upsample):
+            eyes = None
+            if predictor is not None:
+                shape = predictor(small, rect)
+                points = [(shape.part(i).x / scale, shape.part(i).y / scale) for i in range(4)]
+                # 0,1 和 2,3 分别是两只眼睛的眼角，按x坐标区分图中的左右眼
+                eye_a = ((points[0][0] + points[1][0]) / 2, (points[0][1] + points[1][1]) / 2)
+                eye_b = ((points[2][0] + points[3][0]) / 2, (points[2][1] + points[3][1]) / 2)
+                eyes = (eye_a, eye_b) if eye_a[0] <= eye_b[0] else (eye_b, eye_a)
+            x = max(0, int(rect.left() / scale))
+            y = max(0, int(rect.top() / scale))
+            face_w = min(w, int(rect.right() / scale)) - x
+            face_h = min(h, int(rect.bottom() / scale)) - y
+            if face_w > 0 and face_h > 0:
+                faces.append((x, y, face_w, face_h, eyes))
+        return faces
+
+    def _get_dlib_models(self):
+        """
+        获取当前线程的dlib检测器和关键点模型（dlib对象不保证线程安全，每个工作线程各自加载一份）
+        dlib未安装时返回None
+        """
+        if dlib is None:
+            return None
+        models = getattr(self._dlib_local, 'models', None)
+        if models is None:
+            predictor = None
+            if self.dlib_landmarks_path.exists():
+                predictor = dlib.shape_predictor(str(self.dlib_landmarks_path))
+            models = (dlib.get_frontal_face_detector(), predictor)
+            self._dlib_local.models = models
+        return models
+
+    def _locate_heads(self, img, gray, h, w) -> list:
+        """
+        定位每个头部的戴帽参数
+        返回 [(帽子中心x, 帽子中心y, 人脸宽度, 倾斜角度)]，角度单位为度，按cv2约定逆时针为正
+        """
+        start = time.perf_counter()
+        heads = []
+        use_dnn = True
+
+        if self.face_detector == 'dlib':
+            dlib_faces = None
+            try:
+                dlib_faces = self._detect_faces_dlib(gray)
+                if dlib_faces is None:
+                    logger.warn("[圣诞帽] dlib 未安装，回退到 DNN 人脸检测")
+            except Exception as dlib_e:
+                # 与其他检测器一致：单个检测器失败不影响整体，回退到 DNN/级联检测
+                logger.error(f"[圣诞帽] dlib 人脸检测失败，回退到 DNN 人脸检测: {dlib_e}", exc_info=True)
+            if dlib_faces is not None:
+                # dlib已覆盖真人脸，未检测到时只用较轻的级联检测兜底（动漫脸）
+                use_dnn = False
+                logger.info(f"[圣诞帽] dlib 检测到 {len(dlib_faces)} 张人脸: {[face[:4] for face in dlib_faces]}")
+                for (x, y, face_w, face_h, eyes) in dlib_faces:
+                    if eyes is None:
+                        # 没有关键点模型：HOG框上沿约在眉毛处，头顶比其他检测器的框更靠上
+                        heads.append((x + face_w // 2, y - int(face_h * 0.3) + int(face_h * 0.05), face_w, 0.0))
+                        continue
+                    (lx, ly), (rx, ry) = eyes
+                    eye_distance = max(float(np.hypot(rx - lx, ry - ly)), 1.0)
+                    # 头部"向上"方向垂直于两眼连线
+                    up_x, up_y = (ry - ly) / eye_distance, -(rx - lx) / eye_distance
+                    # 头顶约在两眼中点上方1.9倍眼距处，帽子中心再略微下移盖住一点头发
+                    offset = eye_distance * 1.9 - face_h * 0.05
+                    center_x = (lx + rx) / 2 + up_x * offset
+                    center_y = (ly + ry) / 2 + up_y * offset
+                    angle = -float(np.degrees(np.arctan2(ry - ly, rx - lx)))
+                    heads.append((int(center_x), int(center_y), face_w, angle))
+
+        if not heads:
+            for (x, y, face_w, face_h) in self._detect_faces(img, gray, h, w, use_dnn=use_dnn):
+                # 头顶大致位置 = 人脸框上边再往上偏一点，帽子中心再略微下移盖住一点头发
+                approx_head_top_y = y - int(face_h * 0.15)
+                heads.append((x + face_w // 2, approx_head_top_y + int(face_h * 0.05), face_w, 0.0))
+
+        logger.info(f"[圣诞帽] 人脸定位耗时 {(time.perf_counter() - start) * 1000:.1f}ms（{self.face_detector}）")
+        return heads
+
+    def _overlay_hat(self, img, hat_img, head):
+        """按头部参数缩放、旋转圣诞帽并原地叠加到img上"""
+        center_x, center_y, face_w, angle = head
+        logger.info(f"[圣诞帽] 处理人脸: 帽子中心=({center_x}, {center_y}), 人脸宽度={face_w}, 倾斜={angle:.1f}°")
+
+        # 根据人脸宽度计算帽子缩放比例
+        # 这里稍微放大一些，让帽子看起来更夸张，但限制最大尺寸，避免超过整张图太多
+        if hat_img.shape[1] <= 0:
+            logger.warn("[圣诞帽] 圣诞帽图片宽度无效，跳过该人脸")
+            return
+        base_scale = face_w / hat_img.shape[1] * 2.0
+        # 将缩放因子限制在一个合理范围
+        hat_scale = max(0.5, min(base_scale, 3.0))
+
+        hat_width = int(hat_img.shape[1] * hat_scale)
+        hat_height = int(hat_img.shape[0] * hat_scale)
+
+        # 再次根据整张图尺寸进行裁剪限制
+        max_hat_width = img.shape[1] * 2  # 不超过图像宽度的 2 倍
+        max_hat_height = img.shape[0] * 2  # 不超过图像高度的 2 倍
+        hat_width = min(hat_width, max_hat_width)
+        hat_height = min(hat_height, max_hat_height)
+
+        if hat_width <= 0 or hat_height <= 0:
+            logger.warn("[圣诞帽] 计算得到的帽子尺寸无效，跳过该人脸")
+            return
+
+        # 使用INTER_LINEAR而不是INTER_AREA，速度更快
+        resized_hat = cv2.resize(hat_img, (hat_width, hat_height), interpolation=cv2.INTER_LINEAR)
+
+        # 头部倾斜时旋转帽子（扩大画布避免裁掉帽尖，空白处透明）
+        if abs(angle) >= 1.0:
+            matrix = cv2.getRotationMatrix2D((hat_width / 2, hat_height / 2), angle, 1.0)
+            cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+            rotated_width = int(hat_height * sin + hat_width * cos)
+            rotated_height = int(hat_height * cos + hat_width * sin)
+            matrix[0, 2] += rotated_width / 2 - hat_width / 2
+            matrix[1, 2] += rotated_height / 2 - hat_height / 2
+            resized_hat = cv2.warpAffine(
+                resized_hat, matrix, (rotated_width, rotated_height),
+                flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0)
+            )
+            hat_width, hat_height = rotated_width, rotated_height
+
+        # 帽子中心对齐到头部参数给出的位置
+        x1 = center_x - hat_width // 2
+        y1 = center_y - hat_height // 2
+        x2 = x1 + hat_width
+        y2 = y1 + hat_height
+
+        # 若完全在图外则跳过
+        if x1 >= img.shape[1] or y1 >= img.shape[0] or x2 <= 0 or y2 <= 0:
+            logger.warn("[圣诞帽] 帽子完全在图像外部，跳过该人脸")
+            return
+
+        # 计算实际可见区域
+        overlay_x1 = max(0, -x1) if x1 < 0 else 0
+        overlay_y1 = max(0, -y1) if y1 < 0 else 0
+        overlay_x2 = hat_width - max(0, x2 - img.shape[1])
+        overlay_y2 = hat_height - max(0, y2 - img.shape[0])
+
+        roi_x1 = max(x1, 0)
+        roi_y1 = max(y1, 0)
+        roi_x2 = min(x2, img.shape[1])
+        roi_y2 = min(y2, img.shape[0])
+
+        if roi_x1 >= roi_x2 or roi_y1 >= roi_y2:
+            logger.warn("[圣诞帽] 计算得到的 ROI 区域无效，跳过该人脸")
+            return
+
+        roi = img[roi_y1:roi_y2, roi_x1:roi_x2]
+
+        # 提取帽子 RGB 和 Alpha 通道
+        hat_rgb = resized_hat[overlay_y1:overlay_y2, overlay_x1:overlay_x2, :3]
+        alpha_mask = resized_hat[overlay_y1:overlay_y2, overlay_x1:overlay_x2, 3]
+
+        if roi.shape[0] != hat_rgb.shape[0] or roi.shape[1] != hat_rgb.shape[1]:
+            logger.warn(
+                f"[圣诞帽] ROI 与帽子尺寸不匹配，roi={roi.shape}, hat={hat_rgb.shape}，跳过该人脸"
+            )
+            return
+
+        # 使用 Alpha 通道进行融合（roi是img的视图，直接原地写入）
+        _blend_into(roi, hat_rgb, alpha_mask)
+
+    def render_mode3(self, user_image_data: bytes, digest: bytes = None):
+        """
+        模式3：自动识别人脸并戴上圣诞帽！
+        新增的 /add2 功能
+
+        策略：
+        1. 使用 DNN（或 dlib HOG+关键点）/ Anime 级联 / Haar 等多种人脸检测（优先支持较小动漫人脸）
+        2. 根据关键点估计头顶位置和倾斜角度（dlib），旋转并叠加圣诞帽
+        """
+        try:
+            logger.info("[圣诞帽]开始处理图片 圣诞老人正在加速赶来")
+
+            # 检查圣诞帽图片是否已加载
+            if self.hat_img is None:
+                raise FileNotFoundError("圣诞帽图片未加载，请确保 christmas_hat.png 存在于插件目录")
+
+            # 检查圣诞帽图片格式
+            if len(self.hat_img.shape) < 3 or self.hat_img.shape[2] != 4:
+                raise ValueError("圣诞帽图片格式不正确，需要包含Alpha通道的PNG图片")
+
+            # 1. 获取工作图片（解码+缩小，可能命中缓存）
+            # 缓存的数组只读，帽子要原地画上去，复制一份去掉Alpha的BGR图
+            working = self._working_image(user_image_data, digest)
+            img = working.image[..., :3].copy()
+
+            # 2. 使用预加载的圣诞帽图片（只读使用，缩放会生成新数组，无需复制）
+            hat_img = self.hat_img
+
+            # 3. 检测人脸，估计帽子位置和头部倾斜角度（灰度图只读，直接复用缓存）
+            gray = working.gray
+            h, w = gray.shape[:2]
+            logger.info(f"[圣诞帽] 处理图片尺寸: {w}x{h}")
+
+            heads = self._locate_heads(img, gray, h, w)
+            logger.info(f"[圣诞帽] 最终用于戴帽子的人脸/区域数量: {len(heads)}")
+
+            # 4. 为每张人脸添加圣诞帽
+            for head in heads:
+                try:
+                    self._overlay_hat(img, hat_img, head)
+                except Exception as face_e:
+                    logger.error(f"[圣诞帽] 处理单个人脸时出错: {face_e}", exc_info=True)
+                    # 出错时仅跳过当前人脸，继续处理其他人脸
+                    continue
+
+            # 5. 将处理后的 OpenCV 图像转换回字节数据（直接返回编码缓冲区，避免tobytes拷贝）
+            result = _encode_png_cv2(img)
+            logger.info(f"[圣诞帽] 图片处理success，输出大小: {len(result)} 字节")
+            return result
+
+        except Exception as e:
+            logger.error(f"[圣诞帽] 处理出错{e}", exc_info=True)
+            raise
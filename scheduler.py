@@ -0,0 +1,195 @@
+"""
+渲染任务调度器：按估算成本短作业优先，带老化和按会话公平
+
+线程池自带的FIFO队列里，一张8000px大图排在一堆头像前面会让所有人一起等。
+调度器自己维护等待队列，只在有空闲工作线程时才把任务交给线程池：
+- 每个任务的虚拟截止时间 = 提交时间 + 估算成本 * 老化系数 + 同会话积压数 * 会话惩罚，截止时间早的先执行
+  （小任务优先；大任务的截止时间固定，等得足够久后总会排到最前面，不会饿死）
+- 同一会话同时执行的任务数有上限，其他会话有任务等待时不能占满所有线程；没有其他任务时不限制
+"""
+import asyncio
+import heapq
+import io
+import itertools
+from collections import defaultdict, deque
+
+from PIL import Image as PILImage
+
+
+# 各模式的估算成本（秒）：固定开销 + 每百万像素开销（输入越大，解码和缩小越慢）
+MODE_BASE_COST = {'add': 0.3, 'add1': 1.5, 'add2': 0.5}
+MODE_COST_PER_MEGAPIXEL = {'add': 0.03, 'add1': 0.05, 'add2': 0.05}
+
+# 优先级分类（按估算成本上限，秒），用于统计各类任务的排队等待时间
+PRIORITY_CLASSES = (('small', 0.5), ('medium', 2.0), ('large', float('inf')))
+
+# 无法读取图片头时假设的像素数
+DEFAULT_PIXELS = 2000 * 2000
+
+
+def estimate_cost(mode: str, image_data: bytes) -> float:
+    """根据模式和图片头部记录的尺寸估算渲染成本（秒），只读取文件头，不解码像素"""
+    try:
+        with PILImage.open(io.BytesIO(image_data)) as img:
+            pixels = img.width * img.height
+    except Exception:
+        pixels = DEFAULT_PIXELS
+    return MODE_BASE_COST.get(mode, 1.0) + MODE_COST_PER_MEGAPIXEL.get(mode, 0.05) * pixels / 1_000_000
+
+
+def classify_cost(cost: float) -> str:
+    for name, limit in PRIORITY_CLASSES:
+        if cost < limit:
+            return name
+    return PRIORITY_CLASSES[-1][0]
+
+
+class _Job:
+    __slots__ = ('deadline', 'seq', 'session', 'priority_class', 'fn', 'args', 'future', 'submitted')
+
+    def __init__(self, deadline, seq, session, priority_class, fn, args, future, submitted):
+        self.deadline = deadline
+        self.seq = seq
+        self.session = session
+        self.priority_class = priority_class
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.submitted = submitted
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class WaitStats:
+    """单个优先级分类的排队等待时间统计（保留最近的样本计算分位数）"""
+
+    def __init__(self, window: int = 512):
+        self.count = 0
+        self.max_wait = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, wait: float):
+        self.count += 1
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+
+    def snapshot(self) -> dict:
+        samples = sorted(self.recent)
+        if not samples:
+            return {'count': self.count, 'p50': 0.0, 'p95': 0.0, 'max': self.max_wait}
+        return {
+            'count': self.count,
+            'p50': samples[len(samples) // 2],
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max': self.max_wait,
+        }
+
+
+class RenderScheduler:
+    """
+    在线程池前面做优先级调度（只能在事件循环线程中调用）
+    同一时间交给线程池的任务数不超过 workers，其余任务在这里排队
+    """
+
+    def __init__(self, executor, workers: int, aging: float = 4.0, session_penalty: float = 1.0):
+        self.executor = executor
+        self.workers = workers
+        # 每秒估算成本推迟多少秒（越大越偏向小任务，大任务最长等待约为 成本*aging）
+        self.aging = aging
+        # 同会话每个积压任务推迟多少秒
+        self.session_penalty = session_penalty
+        # 有其他会话在等待时，单个会话最多同时占用的工作线程数
+        self.session_limit = max(1, workers // 2)
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._session_queued = defaultdict(int)
+        self._session_running = defaultdict(int)
+        self.wait_stats = {name: WaitStats() for name, _ in PRIORITY_CLASSES}
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap)
+
+    async def submit(self, session: str, cost: float, fn, *args):
+        """按优先级排队，在工作线程中执行 fn(*args) 并返回结果"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        backlog = self._session_queued.get(session, 0) + self._session_running.get(session, 0)
+        job = _Job(
+            deadline=now + cost * self.aging + backlog * self.session_penalty,
+            seq=next(self._seq),
+            session=session,
+            priority_class=classify_cost(cost),
+            fn=fn,
+            args=args,
+            future=loop.create_future(),
+            submitted=now,
+        )
+        heapq.heappush(self._heap, job)
+        self._session_queued[session] += 1
+        self._dispatch()
+        return await job.future
+
+    def _dispatch(self):
+        """有空闲工作线程时，按截止时间取出任务执行"""
+        deferred = []
+        while self._running < self.workers and self._heap:
+            job = heapq.heappop(self._heap)
+            if job.future.done():
+                # 等待者已取消，任务还没开始，直接丢弃
+                self._release_queued(job.session)
+                continue
+            if self._session_running.get(job.session, 0) >= self.session_limit:
+                deferred.append(job)
+                continue
+            self._start(job)
+        # 其他会话都没有可执行的任务时，不让线程空闲（只在有竞争时限制单个会话）
+        for job in deferred:
+            if self._running < self.workers:
+                self._start(job)
+            else:
+                heapq.heappush(self._heap, job)
+
+    def _start(self, job: _Job):
+        loop = asyncio.get_running_loop()
+        self._release_queued(job.session)
+        self._running += 1
+        self._session_running[job.session] += 1
+        self.wait_stats[job.priority_class].record(loop.time() - job.submitted)
+
+        executor_future = loop.run_in_executor(self.executor, job.fn, *job.args)
+        executor_future.add_done_callback(lambda f: self._finish(job, f))
+
+    def _finish(self, job: _Job, executor_future: asyncio.Future):
+        self._running -= 1
+        self._session_running[job.session] -= 1
+        if self._session_running[job.session] <= 0:
+            del self._session_running[job.session]
+
+        if executor_future.cancelled():
+            if not job.future.done():
+                job.future.cancel()
+        else:
+            error = executor_future.exception()
+            if not job.future.done():
+                if error is not None:
+                    job.future.set_exception(error)
+                else:
+                    job.future.set_result(executor_future.result())
+        self._dispatch()
+
+    def _release_queued(self, session: str):
+        self._session_queued[session] -= 1
+        if self._session_queued[session] <= 0:
+            del self._session_queued[session]
+
+    def stats(self) -> dict:
+        """各优先级分类的排队等待时间（秒）以及当前队列状态"""
+        return {
+            'running': self._running,
+            'queued': len(self._heap),
+            'classes': {name: stats.snapshot() for name, stats in self.wait_stats.items()},
+        }
@@ -0,0 +1,87 @@
+"""
+线程预算：让渲染线程池和OpenCV/BLAS内部线程池的总线程数与CPU核心数匹配
+
+每个渲染线程调用 cv2.resize / dnn.forward / detectMultiScale 时，OpenCV还会再开
+一个核心数大小的内部线程池，8个渲染线程 x 8个内部线程会严重超额占用CPU、拉高尾延迟。
+
+两种配置：
+- throughput: 外层线程多、内部单线程，适合并发请求多的场景（总吞吐最高）
+- latency:    外层线程少、内部多线程，单个任务更快完成（单请求延迟最低）
+- legacy:     保持原有行为（线程池 min(核心数, 8)，不限制内部线程）
+"""
+import multiprocessing
+import os
+from typing import NamedTuple
+
+import cv2
+
+try:
+    from astrbot.api import logger
+except ImportError:  # 脱离AstrBot运行（渲染服务/命令行/基准测试）时使用标准logging
+    import logging
+    logger = logging.getLogger("meme_maker")
+
+try:
+    import threadpoolctl
+except ImportError:  # 可选依赖：未安装时只能通过环境变量限制之后加载的BLAS/OpenMP库
+    threadpoolctl = None
+
+
+PROFILES = ('throughput', 'latency', 'legacy')
+
+# 渲染线程池最大线程数（与原有上限一致）
+MAX_WORKERS = 8
+
+# 控制BLAS/OpenMP线程数的环境变量
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+class ThreadBudget(NamedTuple):
+    profile: str
+    workers: int
+    # OpenCV/BLAS每个调用可用的内部线程数，0表示不限制
+    inner_threads: int
+
+
+def available_cpus() -> int:
+    """当前进程可用的CPU数（容器/taskset限制后的实际值）"""
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return multiprocessing.cpu_count()
+
+
+def plan_thread_budget(profile: str = 'throughput', cpus: int = None, workers: int = 0) -> ThreadBudget:
+    """
+    按配置计算线程池大小和内部线程数，保证 workers * inner_threads ≈ CPU数
+    workers > 0 时使用指定的线程池大小，只计算内部线程数
+    """
+    cpus = cpus or available_cpus()
+    if profile not in PROFILES:
+        logger.warn(f"[梗图] 线程配置 {profile!r} 无效，使用 throughput")
+        profile = 'throughput'
+
+    if profile == 'legacy':
+        return ThreadBudget(profile, workers or max(2, min(cpus, MAX_WORKERS)), 0)
+    if not workers:
+        if profile == 'throughput':
+            workers = max(2, min(cpus, MAX_WORKERS))
+        else:
+            # 每个任务约4个内部线程
+            workers = max(2, min(-(-cpus // 4), MAX_WORKERS))
+    return ThreadBudget(profile, workers, max(1, cpus // workers))
+
+
+def apply_thread_budget(budget: ThreadBudget):
+    """设置OpenCV内部线程数和BLAS/OpenMP线程上限（进程级设置）"""
+    if budget.inner_threads <= 0:
+        return
+    cv2.setNumThreads(budget.inner_threads)
+    # 环境变量只对之后加载的库和子进程生效；已加载的库通过threadpoolctl调整
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(budget.inner_threads)
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(limits=budget.inner_threads)
+    logger.info(
+        f"[梗图] 线程预算（{budget.profile}）: 渲染线程 {budget.workers} x 内部线程 {budget.inner_threads}"
+        f"（cv2.getNumThreads={cv2.getNumThreads()}）"
+    )